@@ -1,17 +1,39 @@
 import os
 import re
+import json
+import time
 import logging
+import threading
+import hmac
+import hashlib
+import secrets
+from collections import OrderedDict
+from functools import wraps
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-from datetime import datetime
+from datetime import datetime, date
 from reportlab.lib.utils import simpleSplit
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, make_response
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+# pyarrow é opcional: só é necessário para a exportação analítica
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
 
 app = Flask(__name__)
 app.secret_key = "chave-secreta"  
 app.logger.setLevel(logging.INFO)
 
+# atrás de proxy reverso o remote_addr seria o do proxy; só ative se houver um proxy na frente,
+# senão o cliente pode forjar o X-Forwarded-For
+if os.environ.get('TRIMED_ATRAS_DE_PROXY'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
 # Dados são perdidos ao reiniciar o servidor.
 pacientes = {}
 questionarios = {}
@@ -61,6 +83,250 @@ def validar_cpf(cpf: str) -> bool:
 # registra como filtro Jinja
 app.add_template_filter(format_cpf, name='format_cpf')
 
+'''
+Limite de requisições (token bucket) e coalescência de leituras iguais
+'''
+
+# orçamento por rota: (capacidade do balde, tokens repostos por segundo)
+LIMITES_ROTA = {
+    'index': (30, 1.0),
+    'lista': (20, 0.5),
+    'medico_lista': (20, 0.5),
+    'gerar_receita_pdf': (5, 0.2),
+    'gerar_atestado_pdf': (5, 0.2),
+}
+# vários terminais podem sair pelo mesmo IP (NAT do hospital), então o IP inteiro tem um
+# orçamento mais folgado que serve só de teto para quem troca de cookie a cada requisição
+FATOR_LIMITE_IP = 10
+MAX_BALDES = 10000
+
+_baldes = OrderedDict()  # (rota, cliente): (tokens, ultimo_instante, avisado), do menos ao mais recente
+_baldes_lock = threading.Lock()
+
+def identificar_cliente() -> str:
+    """Sessão (cookie) dentro do IP de origem"""
+    return f"ip:{request.remote_addr}|usuario:{request.cookies.get('usuario_logado', '')}"
+
+def consumir_token(rota: str, cliente: str, fator: int = 1):
+    """
+    Retira um token do balde. Devolve (espera, primeira_recusa): espera é 0 se liberado
+    ou os segundos até o próximo token; primeira_recusa só é True quando o balde acaba de secar.
+    """
+    capacidade, taxa = LIMITES_ROTA[rota]
+    capacidade, taxa = capacidade * fator, taxa * fator
+    agora = time.monotonic()
+    with _baldes_lock:
+        chave = (rota, cliente)
+        tokens, ultimo, avisado = _baldes.get(chave, (capacidade, agora, False))
+        tokens = min(capacidade, tokens + (agora - ultimo) * taxa)
+        espera = 0
+        primeira_recusa = False
+        if tokens < 1:
+            espera = (1 - tokens) / taxa
+            primeira_recusa = not avisado
+            avisado = True
+        else:
+            tokens -= 1
+            avisado = False
+        _baldes[chave] = (tokens, agora, avisado)
+        _baldes.move_to_end(chave)
+        # LRU: descarta o balde usado há mais tempo
+        while len(_baldes) > MAX_BALDES:
+            _baldes.popitem(last=False)
+        return espera, primeira_recusa
+
+def limitar_taxa(view):
+    """Decorador: responde 429 quando a sessão ou o IP estoura o orçamento da rota"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cliente = identificar_cliente()
+        espera, primeira_recusa = consumir_token(request.endpoint, f"ip:{request.remote_addr}", FATOR_LIMITE_IP)
+        if not espera:
+            espera, primeira_recusa = consumir_token(request.endpoint, cliente)
+        else:
+            cliente = f"ip:{request.remote_addr}"
+        if espera:
+            if primeira_recusa:
+                # um aviso por balde seco, para um cliente insistente não inundar o log
+                app.logger.warning(f"Limite excedido em {request.endpoint} por {cliente}")
+            resp = make_response('Muitas requisições. Tente novamente em instantes.', 429)
+            resp.headers['Retry-After'] = str(int(espera) + 1)
+            return resp
+        return view(*args, **kwargs)
+    return wrapper
+
+class _Voo:
+    """Cálculo em andamento compartilhado pelas requisições com a mesma chave"""
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+_voos = {}
+_voos_lock = threading.Lock()
+
+def coalescer(chave, funcao):
+    """Single-flight: requisições simultâneas com a mesma chave esperam o primeiro cálculo"""
+    with _voos_lock:
+        voo = _voos.get(chave)
+        lider = voo is None
+        if lider:
+            voo = _Voo()
+            _voos[chave] = voo
+
+    if not lider:
+        voo.evento.wait()
+        if voo.erro is not None:
+            # exceção nova por requisição: a original é compartilhada e não pode acumular tracebacks
+            raise RuntimeError(f"Falha no cálculo compartilhado {chave!r}") from voo.erro
+        return voo.resultado
+
+    try:
+        voo.resultado = funcao()
+    except Exception as e:
+        voo.erro = e
+        raise
+    finally:
+        with _voos_lock:
+            _voos.pop(chave, None)
+        voo.evento.set()
+    return voo.resultado
+
+def extrair_pressao(pressao: str):
+    """Separa sistólica/diastólica de textos como 140/90; devolve (None, None) se não houver"""
+    match = re.match(r"(\d{2,3})\s*[/\\]\s*(\d{2,3})", pressao or '')
+    if not match:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+'''
+Cache de dados derivados (idade, IMC)
+'''
+
+class CacheDerivados:
+    """
+    LRU limitado (por paciente) para valores calculados a partir dos registros. Cada
+    valor guarda a versão (os campos de origem) com que foi calculado; se os campos
+    mudarem, a próxima leitura recalcula.
+    """
+    def __init__(self, tamanho_max=1024):
+        self.tamanho_max = tamanho_max  # em pacientes
+        self._itens = OrderedDict()  # cpf: {calculo: (versao, valor)}
+        self._lock = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.descartes = 0
+
+    def obter(self, cpf, calculo, versao, funcao):
+        with self._lock:
+            item = self._itens.get(cpf, {}).get(calculo)
+            if item is not None and item[0] == versao:
+                self._itens.move_to_end(cpf)
+                self.acertos += 1
+                return item[1]
+            self.falhas += 1
+
+        valor = funcao()
+        with self._lock:
+            self._itens.setdefault(cpf, {})[calculo] = (versao, valor)
+            self._itens.move_to_end(cpf)
+            while len(self._itens) > self.tamanho_max:
+                self._itens.popitem(last=False)
+                self.descartes += 1
+        return valor
+
+    def invalidar(self, cpf):
+        """Descarta o que foi calculado para o CPF (libera a memória ao alterar/remover o registro)"""
+        with self._lock:
+            self._itens.pop(cpf, None)
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                'pacientes': len(self._itens),
+                'itens': sum(len(calculos) for calculos in self._itens.values()),
+                'tamanho_max': self.tamanho_max,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'descartes': self.descartes,
+                'taxa_acerto': round(self.acertos / total, 3) if total else 0.0,
+            }
+
+cache_derivados = CacheDerivados()
+
+def classificar_imc(imc: float) -> str:
+    if imc < 18.5:
+        return "Abaixo do peso"
+    elif imc < 24.9:
+        return "Peso normal"
+    elif imc < 30:
+        return "Sobrepeso"
+    elif imc < 35:
+        return "Obesidade grau I"
+    elif imc < 40:
+        return "Obesidade grau II"
+    return "Obesidade grau III"
+
+def _calcular_imc(cpf, altura, peso):
+    try:
+        peso_val = float(peso or 0)
+        altura_val = float(altura or 0) / 100  # converter cm para metros
+    except (ValueError, TypeError):
+        app.logger.warning(f"Erro ao calcular IMC para paciente {cpf} com peso={peso} e altura={altura}")
+        return None, None
+    if peso_val <= 0 or altura_val <= 0:
+        return None, None
+    imc = round(peso_val / (altura_val ** 2), 1)
+    return imc, classificar_imc(imc)
+
+def _calcular_idade(cpf, data_nasc, hoje):
+    if not data_nasc:
+        return 0
+    try:
+        nasc = datetime.strptime(data_nasc, "%Y-%m-%d")
+    except (ValueError, TypeError):
+        app.logger.warning(f"Data de nascimento inválida para CPF {cpf}: {data_nasc}")
+        return 0
+    return hoje.year - nasc.year - ((hoje.month, hoje.day) < (nasc.month, nasc.day))
+
+def imc_paciente(cpf, paciente):
+    """(imc, classificacao) do paciente, ou (None, None) sem altura/peso válidos"""
+    altura, peso = paciente.get('altura'), paciente.get('peso')
+    return cache_derivados.obter(cpf, 'imc', (altura, peso), lambda: _calcular_imc(cpf, altura, peso))
+
+def idade_paciente(cpf, paciente) -> int:
+    """Idade pela data de nascimento (0 se ausente ou inválida)"""
+    data_nasc = paciente.get('data_nascimento')
+    hoje = date.today()  # a idade muda com o dia, então ele faz parte da versão
+    return cache_derivados.obter(cpf, 'idade', (data_nasc, hoje), lambda: _calcular_idade(cpf, data_nasc, hoje))
+
+def montar_triagem():
+    """Lista de triagem ordenada por prioridade"""
+    triagem = []
+    for cpf, q in list(questionarios.items()):
+        paciente = pacientes.get(cpf)
+        if paciente:
+            triagem.append({
+                "cpf": cpf,
+                "nome": paciente.get("nome"),
+                "prioridade": q.get("prioridade", "Não Urgente")
+            })
+
+    # definindo a ordem de prioridade para ordenação
+    ordem_prioridade = {"Emergencia": 1, "Muito Urgente": 2, "Urgente": 3, "Pouco Urgente": 4, "Não Urgente": 5}
+    triagem.sort(key=lambda x: (ordem_prioridade.get(x["prioridade"], 5)))
+    return triagem
+
+def buscar_pacientes(q: str):
+    """Filtra pacientes por nome ou CPF (q já em minúsculas)"""
+    lista_pacientes = []
+    for cpf, p in list(pacientes.items()):
+        nome = (p.get('nome') or '').lower()
+        if not q or q in nome or q in cpf:
+            lista_pacientes.append({'cpf': cpf, **p})
+    return lista_pacientes
+
 #rota que redireciona para login, pq senao abre direto o index
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -80,6 +346,7 @@ def login():
     return render_template('login.html')
 
 @app.route('/index', methods=['GET','POST'])
+@limitar_taxa
 def index():
     #pegar o cookie do usuario logado
     usuario = request.cookies.get('usuario_logado')
@@ -97,20 +364,8 @@ def index():
         # aceitar qualquer CPF numérico para testes
         return redirect(url_for('paciente', cpf=cpf))
     
-    #lista por prioridade
-    triagem = []
-    for cpf, q in questionarios.items():
-        paciente = pacientes.get(cpf)
-        if paciente:
-            triagem.append({
-                "cpf": cpf,
-                "nome": paciente.get("nome"),
-                "prioridade": q.get("prioridade", "Não Urgente")
-            })
-
-    # definindo a ordem de prioridade para ordenação
-    ordem_prioridade = {"Emergencia": 1, "Muito Urgente": 2, "Urgente": 3, "Pouco Urgente": 4, "Não Urgente": 5}
-    triagem.sort(key=lambda x: (ordem_prioridade.get(x["prioridade"], 5)))
+    #lista por prioridade (acessos simultâneos compartilham o mesmo cálculo)
+    triagem = coalescer(('triagem',), montar_triagem)
 
     return render_template('index.html', triagem=triagem, usuario=usuario)
 
@@ -191,6 +446,7 @@ def paciente(cpf):
             'cep': cep,
             'bairro': bairro,
             'rua': rua,
+            'atualizado_em': datetime.now().isoformat(timespec='seconds'),
         }
 
         if dados:
@@ -203,41 +459,23 @@ def paciente(cpf):
                 'cep': paciente_data['cep'],
                 'bairro': paciente_data['bairro'],
                 'rua': paciente_data['rua'],
+                'atualizado_em': datetime.now().isoformat(timespec='seconds'),
             })
             pacientes[cpf] = atual
+            cache_derivados.invalidar(cpf)
             flash('Dados atualizados com sucesso.', 'success')
             app.logger.info(f"Paciente {cpf} atualizado.")
         else:
             # Cria novo paciente (inclui imutáveis vindos do form ao criar)
             pacientes[cpf] = paciente_data
+            cache_derivados.invalidar(cpf)
             flash('Paciente cadastrado com sucesso.', 'success')
             app.logger.info(f"Paciente {cpf} cadastrado.")
 
         return redirect(url_for('paciente', cpf=cpf))
 
     if dados:
-        try:
-            peso_val = float(dados.get('peso', 0))
-            altura_val = float(dados.get('altura', 0)) / 100 
-            if peso_val > 0 and altura_val > 0:
-                imc = round(peso_val / (altura_val ** 2), 1)
-                pacientes[cpf]['imc'] = imc
-                # Classificação do IMC
-                if imc < 18.5:
-                    classificacao = "Abaixo do peso"
-                elif imc < 24.9:
-                    classificacao = "Peso normal"
-                elif imc < 30:
-                    classificacao = "Sobrepeso"
-                elif imc < 35:
-                    classificacao = "Obesidade grau I"
-                elif imc < 40:
-                    classificacao = "Obesidade grau II"
-                else:
-                    classificacao = "Obesidade grau III"
-
-        except (ValueError, TypeError):
-            app.logger.warning(f"Erro ao calcular IMC para paciente {cpf} com peso={dados.get('peso')} e altura={dados.get('altura')}")
+        imc, classificacao = imc_paciente(cpf, dados)
 
     return render_template('paciente.html', cpf=cpf, dados=dados, imc=imc, classificacao=classificacao, usuario=usuario)
 
@@ -255,7 +493,7 @@ def questionario(cpf):
         flash("Paciente não encontrado. Cadastre-o antes de preencher o questionário.", "warning")
         return redirect(url_for("index"))
 
-    imc = paciente.get('imc', None) 
+    imc, _ = imc_paciente(cpf, paciente)
     pontos_pressao = 0
     pontos_temp=0
     pontos_idade = 0
@@ -263,16 +501,8 @@ def questionario(cpf):
     pontos_outros =0
     idade_temp_int = None
 
-    # calcula idade a partir da data de nascimento do paciente
-    idade = 0
-    data_nasc = paciente.get("data_nascimento")
-    if data_nasc:
-        try:
-            nasc = datetime.strptime(data_nasc, "%Y-%m-%d")
-            hoje = datetime.today()
-            idade = hoje.year - nasc.year - ((hoje.month, hoje.day) < (nasc.month, nasc.day))
-        except ValueError:
-            app.logger.warning(f"Data de nascimento inválida para CPF {cpf}: {data_nasc}")
+    # idade a partir da data de nascimento do paciente
+    idade = idade_paciente(cpf, paciente)
 
     if request.method == "POST":
         fumante = request.form.get("fumante") == "on"
@@ -299,6 +529,7 @@ def questionario(cpf):
                 except ValueError:
                     idade_temp_int = None                
 
+            pacientes.setdefault(cpf, {})['atualizado_em'] = datetime.now().isoformat(timespec='seconds')
             # atualizar a variável local paciente para refletir mudanças
             paciente = pacientes.get(cpf)
 
@@ -310,17 +541,9 @@ def questionario(cpf):
                 pacientes.setdefault(cpf, {})['altura'] = altura
             if peso:
                 pacientes.setdefault(cpf, {})['peso'] = peso
-                #calculo de imc para paciente temporario
-            imc = None
-            try:
-                if altura and peso:
-                    altura_m = float(altura) / 100  # converter cm para metros
-                    peso = float(peso)
-                if altura_m > 0:
-                    imc = round(peso / (altura_m ** 2), 1)
-                    pacientes[cpf]['imc'] = imc  # salvar no paciente temporário
-            except (ValueError, TypeError):
-                pass
+            cache_derivados.invalidar(cpf)
+            #calculo de imc para paciente temporario
+            imc, _ = imc_paciente(cpf, pacientes.get(cpf, {}))
         
         if (alergia_bool == "sim" and not alergias) or (historico_bool == "sim" and not historico_doencas) or (medicamento_bool == "sim" and not medicamentos):
             flash("Se marcou 'Sim' em Alergia, Histórico ou Medicamentos, preencha o respectivo detalhe.", "warning")
@@ -346,12 +569,8 @@ def questionario(cpf):
         prioridade_auto = "Não Urgente"
         sistolica = diastolica = None
         # Tenta extrair pressão numérica do campo (ex: 140/90)
-        import re
-        match = re.match(r"(\d{2,3})\s*[/\\]\s*(\d{2,3})", pressao)
-        if match:
-            sistolica = int(match.group(1))
-            diastolica = int(match.group(2))
-
+        sistolica, diastolica = extrair_pressao(pressao)
+        if sistolica is not None:
             if sistolica < 90 or diastolica < 60:
                 pontos_pressao = 2  # pressão baixa
             elif 90 <= sistolica <= 120 and 60 <= diastolica <= 80:
@@ -440,9 +659,12 @@ def questionario(cpf):
             "prioridade_auto": prioridade_auto,
             "prioridade": prioridade_final,
             "idade": idade,
-            "grau_urgencia": prioridade_auto
+            "grau_urgencia": prioridade_auto,
+            "registrado_em": datetime.now().isoformat(timespec='seconds')
         }
 
+        cache_derivados.invalidar(cpf)
+
         flash(f"Questionário salvo! Prioridade: {prioridade_final} (automática: {prioridade_auto})", "success")
         return redirect(url_for("questionario", cpf=cpf))
 
@@ -462,12 +684,14 @@ def questionario_sem_cpf():
     pacientes[new_cpf] = {
         'nome': '',
         'data_nascimento': None,
-        'idade': None
+        'idade': None,
+        'atualizado_em': datetime.now().isoformat(timespec='seconds')
     }
     flash('Paciente temporário criado. Preencha o questionário informando nome/idade.', 'info')
     return redirect(url_for('questionario', cpf=new_cpf))
 
 @app.route('/lista')
+@limitar_taxa
 def lista():
     usuario = request.cookies.get('usuario_logado')
     if not usuario:
@@ -475,11 +699,7 @@ def lista():
         return redirect(url_for('login'))
 
     q = request.args.get('q','').lower().strip()
-    lista_pacientes = []
-    for cpf, p in pacientes.items():
-        nome = (p.get('nome') or '').lower()
-        if not q or q in nome or q in cpf:
-            lista_pacientes.append({'cpf': cpf, **p})
+    lista_pacientes = coalescer(('busca', q), lambda: buscar_pacientes(q))
     return render_template('lista.html',usuario=usuario ,pacientes=lista_pacientes, q=q)
 
 @app.route('/deletar/<cpf>')
@@ -489,6 +709,7 @@ def deletar(cpf):
     
     if cpf in pacientes:
         del pacientes[cpf]
+        cache_derivados.invalidar(cpf)
         flash('Paciente removido.', 'info')
     else:
         flash('Paciente não encontrado.', 'warning')
@@ -499,22 +720,27 @@ def api_pacientes():
         cpf = clean_cpf(cpf)
     return jsonify(pacientes)
 
+@app.route('/api/cache')
+def api_cache():
+    usuario = request.cookies.get('usuario_logado')
+    if not usuario:
+        flash('Faça login primeiro.', 'warning')
+        return redirect(url_for('login'))
+    return jsonify(cache_derivados.estatisticas())
+
 dados_medicos = {}  #como cpf: {receita: " ", atestado: " "}
 '''
 Área do médico
 '''
 
 @app.route('/medico')
+@limitar_taxa
 def medico_lista():
     """
     aqui será a lista de pacientes para o médico acessar
     """
     q = request.args.get('q','').lower().strip()
-    lista_pacientes = []
-    for cpf, p in pacientes.items():
-        nome = (p.get('nome') or '').lower()
-        if not q or q in nome or q in cpf:
-            lista_pacientes.append({'cpf': cpf, **p})
+    lista_pacientes = coalescer(('busca', q), lambda: buscar_pacientes(q))
     return render_template('lista.html', pacientes=lista_pacientes, q=q)
 
 @app.route('/medico/<cpf>', methods=['GET', 'POST'])
@@ -573,19 +799,8 @@ def medico_paciente(cpf):
         dados=dados
     )
 
-@app.route('/pdf/receita/<cpf>')
-def gerar_receita_pdf(cpf):
-    if not cpf.startswith("cpf temporario-"):
-        cpf = clean_cpf(cpf)
-
-    paciente = pacientes.get(cpf)
-    dados = dados_medicos.get(cpf)
-
-    if not paciente or not dados:
-        flash("Paciente ou receita não encontrada.", "warning")
-        return redirect(url_for('medico_lista'))
-
-
+def montar_receita_pdf(paciente, dados) -> bytes:
+    """Gera o PDF da receita e devolve os bytes"""
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
     largura, altura = A4
@@ -636,21 +851,10 @@ def gerar_receita_pdf(cpf):
 
     c.showPage()
     c.save()
-    buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name=f"receita_{paciente.get('nome','paciente').replace(' ', '_')}.pdf", mimetype='application/pdf')
+    return buffer.getvalue()
 
-@app.route('/pdf/atestado/<cpf>')
-def gerar_atestado_pdf(cpf):
-    if not cpf.startswith("cpf temporario-"):
-        cpf = clean_cpf(cpf)    
-
-    paciente = pacientes.get(cpf)
-    dados = dados_medicos.get(cpf)
-
-    if not paciente or not dados:
-        flash("Paciente ou atestado não encontrado.", "warning")
-        return redirect(url_for('medico_lista'))
-    
+def montar_atestado_pdf(paciente, dados) -> bytes:
+    """Gera o PDF do atestado e devolve os bytes"""
     buffer = BytesIO()
     c = canvas.Canvas(buffer, pagesize=A4)
     largura, altura = A4
@@ -700,15 +904,260 @@ def gerar_atestado_pdf(cpf):
 
     c.showPage()
     c.save()
-    buffer.seek(0)
+    return buffer.getvalue()
+
+@app.route('/pdf/receita/<cpf>')
+@limitar_taxa
+def gerar_receita_pdf(cpf):
+    if not cpf.startswith("cpf temporario-"):
+        cpf = clean_cpf(cpf)
+
+    paciente = pacientes.get(cpf)
+    dados = dados_medicos.get(cpf)
+
+    if not paciente or not dados:
+        flash("Paciente ou receita não encontrada.", "warning")
+        return redirect(url_for('medico_lista'))
+
+    # terminais baixando a mesma receita ao mesmo tempo compartilham a geração
+    pdf = coalescer(('receita', cpf, dados.get('ultima_edicao')), lambda: montar_receita_pdf(paciente, dados))
+    return send_file(BytesIO(pdf), as_attachment=True, download_name=f"receita_{paciente.get('nome','paciente').replace(' ', '_')}.pdf", mimetype='application/pdf')
+
+@app.route('/pdf/atestado/<cpf>')
+@limitar_taxa
+def gerar_atestado_pdf(cpf):
+    if not cpf.startswith("cpf temporario-"):
+        cpf = clean_cpf(cpf)    
+
+    paciente = pacientes.get(cpf)
+    dados = dados_medicos.get(cpf)
+
+    if not paciente or not dados:
+        flash("Paciente ou atestado não encontrado.", "warning")
+        return redirect(url_for('medico_lista'))
+
+    nome_paciente = paciente.get('nome') or "______"
+    pdf = coalescer(('atestado', cpf, dados.get('ultima_edicao')), lambda: montar_atestado_pdf(paciente, dados))
 
     return send_file(
-        buffer,
+        BytesIO(pdf),
         as_attachment=True,
         download_name=f"atestado_{nome_paciente.replace(' ', '_')}.pdf",
         mimetype='application/pdf'
     )
 
+'''
+Exportação analítica (Parquet/Arrow)
+'''
+
+PASTA_EXPORTACAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exportacao')
+
+# o CPF não vai para os arquivos: cada paciente vira um identificador HMAC com este sal
+SAL_EXPORTACAO = os.environ.get('TRIMED_SAL_EXPORTACAO') or secrets.token_hex(16)
+
+# guardado dentro do destino para sobreviver a reinícios:
+# {formato: {tabela: {paciente_id: carimbo já exportado}}}
+ARQUIVO_ESTADO = '_estado.json'
+_exportacao_lock = threading.Lock()
+
+def id_paciente_exportacao(cpf: str) -> str:
+    """Identificador estável (para joins) que não expõe o CPF"""
+    return hmac.new(SAL_EXPORTACAO.encode(), cpf.encode(), hashlib.sha256).hexdigest()[:20]
+
+def _para_float(valor):
+    try:
+        return float(str(valor).replace(',', '.'))
+    except (ValueError, TypeError):
+        return None
+
+def _para_data(valor):
+    try:
+        return datetime.strptime(valor, "%Y-%m-%d").date()
+    except (ValueError, TypeError):
+        return None
+
+def _para_datahora(valor):
+    try:
+        return datetime.fromisoformat(valor)
+    except (ValueError, TypeError):
+        return None
+
+def _ler_estado_exportacao(destino):
+    try:
+        with open(os.path.join(destino, ARQUIVO_ESTADO), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _gravar_estado_exportacao(destino, estado):
+    os.makedirs(destino, exist_ok=True)
+    caminho = os.path.join(destino, ARQUIVO_ESTADO)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(estado, f)
+    os.replace(caminho + '.tmp', caminho)
+
+def _gravar_parte(tabela_arrow, caminho, formato):
+    """Grava um arquivo novo de forma atômica; não deixa o .tmp para trás se falhar"""
+    temporario = caminho + '.tmp'
+    try:
+        if formato == 'parquet':
+            pq.write_table(tabela_arrow, temporario)
+        else:
+            feather.write_feather(tabela_arrow, temporario)
+        os.replace(temporario, caminho)
+    except Exception:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+def _schemas_exportacao():
+    texto_dict = pa.dictionary(pa.int32(), pa.string())
+    return {
+        'pacientes': pa.schema([
+            ('paciente_id', pa.string()),
+            ('genero', texto_dict),
+            ('tipo_sanguineo', texto_dict),
+            ('data_nascimento', pa.date32()),
+            ('idade', pa.int16()),
+            ('altura_cm', pa.float32()),
+            ('peso_kg', pa.float32()),
+            ('cep', pa.string()),
+            ('bairro', texto_dict),
+            ('atualizado_em', pa.timestamp('s')),
+        ]),
+        'questionarios': pa.schema([
+            ('paciente_id', pa.string()),
+            ('registrado_em', pa.timestamp('s')),
+            ('hora', pa.int8()),
+            ('idade', pa.int16()),
+            ('pressao_sistolica', pa.int16()),
+            ('pressao_diastolica', pa.int16()),
+            ('temperatura', pa.float32()),
+            ('fumante', pa.bool_()),
+            ('alcoolatra', pa.bool_()),
+            ('diabetico', pa.bool_()),
+            ('hipertenso', pa.bool_()),
+            ('usa_medicamento', pa.bool_()),
+            ('possui_alergia', pa.bool_()),
+            ('possui_historico', pa.bool_()),
+            ('prioridade_auto', texto_dict),
+            ('prioridade', texto_dict),
+        ]),
+    }
+
+def _linha_paciente(cpf, p):
+    return {
+        'paciente_id': id_paciente_exportacao(cpf),
+        'genero': p.get('genero') or None,
+        'tipo_sanguineo': p.get('tipo_sanguineo') or None,
+        'data_nascimento': _para_data(p.get('data_nascimento')),
+        'idade': p.get('idade') if isinstance(p.get('idade'), int) else None,
+        'altura_cm': _para_float(p.get('altura')),
+        'peso_kg': _para_float(p.get('peso')),
+        'cep': p.get('cep') or None,
+        'bairro': p.get('bairro') or None,
+        'atualizado_em': _para_datahora(p.get('atualizado_em')),
+    }
+
+def _linha_questionario(cpf, q):
+    registrado_em = _para_datahora(q.get('registrado_em'))
+    sistolica, diastolica = extrair_pressao(q.get('pressao'))
+    # só campos do próprio questionário; bairro etc. vêm do join com pacientes
+    idade = q.get('idade')
+    return {
+        'paciente_id': id_paciente_exportacao(cpf),
+        'registrado_em': registrado_em,
+        'hora': registrado_em.hour if registrado_em else None,
+        'idade': idade if isinstance(idade, int) and idade > 0 else None,  # 0 = sem data de nascimento
+        'pressao_sistolica': sistolica,
+        'pressao_diastolica': diastolica,
+        'temperatura': _para_float(q.get('temperatura')),
+        'fumante': bool(q.get('fumante')),
+        'alcoolatra': bool(q.get('alcoolatra')),
+        'diabetico': bool(q.get('diabetico')),
+        'hipertenso': bool(q.get('hipertenso')),
+        'usa_medicamento': q.get('medicamento_bool') == 'sim',
+        'possui_alergia': q.get('alergia_bool') == 'sim',
+        'possui_historico': q.get('historico_bool') == 'sim',
+        'prioridade_auto': q.get('prioridade_auto') or None,
+        'prioridade': q.get('prioridade') or None,
+    }
+
+def exportar_analitico(destino=PASTA_EXPORTACAO, formato='parquet'):
+    """
+    Acrescenta pacientes e questionários a arquivos colunares particionados por dia
+    (destino/<tabela>/dia=AAAA-MM-DD/part-<instante>.parquet). Só entram os registros
+    cujo carimbo mudou desde a última exportação para o mesmo destino e formato; arquivos
+    já gravados nunca são apagados nem regravados. Cada questionário salvo vira uma linha;
+    em pacientes, o cadastro atual é a linha mais recente de cada paciente_id.
+    Devolve os arquivos escritos.
+    """
+    if pa is None:
+        raise RuntimeError('pyarrow não está instalado: pip install pyarrow')
+    if formato not in ('parquet', 'arrow'):
+        raise ValueError(f"Formato de exportação inválido: {formato}")
+
+    schemas = _schemas_exportacao()
+    fontes = {
+        'pacientes': (pacientes, 'atualizado_em', _linha_paciente),
+        'questionarios': (questionarios, 'registrado_em', _linha_questionario),
+    }
+    instante = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    escritas = []
+    with _exportacao_lock:
+        estado = _ler_estado_exportacao(destino)
+        estado_formato = estado.setdefault(formato, {})
+        try:
+            for tabela, (registros, campo_data, montar_linha) in fontes.items():
+                if not os.path.isdir(os.path.join(destino, tabela)):
+                    estado_formato.pop(tabela, None)  # pasta nova ou apagada: exporta tudo
+                exportados = estado_formato.setdefault(tabela, {})
+
+                novos_por_dia = {}
+                for cpf, registro in list(registros.items()):
+                    carimbo = registro.get(campo_data) or ''
+                    paciente_id = id_paciente_exportacao(cpf)
+                    if exportados.get(paciente_id) == carimbo:
+                        continue
+                    dia = carimbo[:10] or 'sem-data'
+                    novos_por_dia.setdefault(dia, []).append((paciente_id, carimbo, montar_linha(cpf, registro)))
+
+                for dia, novos in sorted(novos_por_dia.items()):
+                    pasta = os.path.join(destino, tabela, f"dia={dia}")
+                    os.makedirs(pasta, exist_ok=True)
+                    caminho = os.path.join(pasta, f"part-{instante}.{formato}")
+                    linhas = [linha for _, _, linha in novos]
+                    _gravar_parte(pa.Table.from_pylist(linhas, schema=schemas[tabela]), caminho, formato)
+                    escritas.append(caminho)
+                    for paciente_id, carimbo, _ in novos:
+                        exportados[paciente_id] = carimbo
+        finally:
+            # guarda o que já foi escrito mesmo se uma partição falhar
+            _gravar_estado_exportacao(destino, estado)
+
+    app.logger.info(f"Exportação analítica: {len(escritas)} arquivo(s) gravado(s) em {destino}")
+    return escritas
+
+#os dados só existem na memória do servidor, então a exportação é feita por esta rota
+@app.route('/exportar', methods=['POST'])
+def exportar():
+    usuario = request.cookies.get('usuario_logado')
+    if not usuario:
+        flash('Faça login primeiro.', 'warning')
+        return redirect(url_for('login'))
+
+    try:
+        escritas = exportar_analitico()
+    except RuntimeError as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('index'))
+    except OSError as e:
+        app.logger.error(f"Falha na exportação analítica: {e}")
+        flash(f'Falha ao gravar a exportação: {e}', 'warning')
+        return redirect(url_for('index'))
+    flash(f'Exportação concluída: {len(escritas)} arquivo(s) gravado(s).', 'success')
+    return redirect(url_for('index'))
+
 #rota de logout(criada para deletar o cookie de usuario_logado)
 @app.route('/logout')
 def logout():